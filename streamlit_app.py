@@ -1,88 +1,650 @@
 import streamlit as st
-from openai import OpenAI
-import json
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import asyncio
+import httpx
+import functools
+import orjson
 import os
+from operator import itemgetter
+import secrets
+import queue
+import stat
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 # --- Configuration and Constants ---
 DB_FILE = 'db.json'
+LOG_FILE = 'db_log.ndjson'
+CHATS_DIR = 'chats'
+LOG_COMPACT_BYTES = 1024 * 1024
+HISTORY_WINDOW = 20
+MAX_SENT_MESSAGES = 2 * HISTORY_WINDOW
+RENDERED_TAIL = 10
+RECENT_CHATS = 20
+STREAM_REPAINT_SECONDS = 0.05
+TITLE_WAIT_SECONDS = 5
+SUMMARY_WAIT_SECONDS = 5
 DEFAULT_TITLE = "New Chat"
+HIDE_BADGE_CSS = (
+    "<style>.css-1jc7ptx,.e1ewe7hr3,.viewerBadge_container__1QSob,.styles_viewerBadge__1yB5_,"
+    ".viewerBadge_link__1S137,.viewerBadge_text__1JaDK{display:none}</style>"
+)
 
 # --- Main App UI ---
 st.title("SACR AI Research UI")
 
-# --- Custom CSS for sidebar buttons ---
-st.markdown("""
-<style>
-    .css-1jc7ptx, .e1ewe7hr3, .viewerBadge_container__1QSob,
-    .styles_viewerBadge__1yB5_, .viewerBadge_link__1S137,
-    .viewerBadge_text__1JaDK {
-        display: none;
-    }
-    /* Target the main chat title button in the first column */
-    div[data-testid="stHorizontalBlock"] > div:nth-of-type(1) .stButton button {
-        justify-content: flex-start !important;
-        text-align: left !important;
-        overflow: hidden;
-        white-space: nowrap;
-        text-overflow: ellipsis;
-    }
-    /* Target the options button in the second column */
-    div[data-testid="stHorizontalBlock"] > div:nth-of-type(2) .stButton button {
-        justify-content: center !important;
-    }
-</style>
-""", unsafe_allow_html=True)
+# --- Custom CSS ---
+# Streamlit drops any element a rerun does not emit again, so this has to be sent on every
+# run; keeping it one short line keeps that per-rerun cost negligible.
+st.markdown(HIDE_BADGE_CSS, unsafe_allow_html=True)
+
+
+# --- OpenAI Client ---
+# One event loop thread and one client per process, shared by every session and rerun,
+# so the client's keep-alive connection pool is reused instead of rebuilt each run.
+# Network coroutines run on that loop; the script thread only waits on their results.
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="openai-event-loop", daemon=True).start()
+    return loop
+
+@st.cache_resource
+def get_openai_client():
+    # httpx drops idle keep-alive connections after 5 s by default, which is shorter than
+    # the gap between most chat turns; keep them long enough for the next message to
+    # skip the TCP and TLS handshakes.
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=10, keepalive_expiry=120),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+    return AsyncOpenAI(api_key=st.secrets["OPENAI_API_KEY"], http_client=http_client, max_retries=2)
+
+def run_async(coro):
+    """Schedule `coro` on the shared loop and return a concurrent.futures.Future."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
 
+def iterate_async(async_iterable):
+    iterator = async_iterable.__aiter__()
+    while True:
+        try:
+            yield run_async(iterator.__anext__()).result()
+        except StopAsyncIteration:
+            return
+
+def background_result(future, error_message, fallback=None):
+    # Results are collected on the script thread, the only one that may call st.*.
+    try:
+        return future.result()
+    except Exception as e:
+        st.toast(f"{error_message}: {e}", icon="🤖")
+        return fallback
 
 # Initialize OpenAI client from Streamlit secrets
 try:
-    client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+    client = get_openai_client()
 except Exception:
     st.error("OpenAI API key not found. Please add it to your Streamlit secrets.", icon="🚨")
     st.stop()
 
 
 # --- Database Functions ---
-def load_db():
-    if not os.path.exists(DB_FILE) or os.path.getsize(DB_FILE) == 0:
-        return {'chats': {}}
+# db.json is a compacted snapshot of the chat index (titles and creation times); every
+# index change since then is an event in LOG_FILE. Messages live in one append-only
+# file per chat under CHATS_DIR, so only the active conversation is ever read.
+def _empty_db():
+    return {'chats': {}}
+
+def chat_file(chat_id):
+    return os.path.join(CHATS_DIR, f"{chat_id}.ndjson")
+
+def _load_snapshot():
     try:
-        with open(DB_FILE, 'r') as file:
-            data = json.load(file)
+        with open(DB_FILE, 'rb') as file:
+            data = orjson.loads(file.read())
             if 'chats' not in data or not isinstance(data.get('chats'), dict):
-                return {'chats': {}}
+                return _empty_db()
             return data
-    except (json.JSONDecodeError, FileNotFoundError):
-        return {'chats': {}}
-
-def save_db(db):
-    with open(DB_FILE, 'w') as file:
-        json.dump(db, file, indent=4)
-
-def generate_title(chat_history):
-    history_summary = [{"role": msg["role"], "content": msg["content"][:200]} for msg in chat_history]
-    title_prompt = f"""
-    Based on the following conversation, generate a short, concise title (4-5 words max).
-    The title should be plain text, without any markdown or quotation marks.
-    ---
-    {json.dumps(history_summary)}
-    ---
-    Title:"""
+    except (orjson.JSONDecodeError, FileNotFoundError):
+        return _empty_db()
+
+def apply_chat_event(chat, event):
+    op = event.get('op')
+    if op == 'append_msg':
+        messages = chat.setdefault('messages', [])
+        if event.get('idx', len(messages)) == len(messages):
+            messages.append(event['msg'])
+    elif op == 'summarize':
+        chat['summary'] = event['summary']
+        chat['summary_upto'] = event['upto']
+    elif op == 'respond':
+        chat['response_id'] = event['id']
+        chat['response_upto'] = event['upto']
+        chat['response_base'] = event['base']
+    elif op == 'cut_off':
+        # A new dict rather than an update, since the loaded chat may be the shared cached one.
+        chat['cut_off'] = {**chat.get('cut_off', {}), event['idx']: event['reason']}
+
+def apply_event(db, event):
+    chats = db['chats']
+    op = event.get('op')
+    chat_id = event.get('chat_id')
+    if op == 'new_chat':
+        chats.setdefault(chat_id, {
+            'title': event.get('title', DEFAULT_TITLE),
+            'created_at': event.get('created_at', 0),
+        })
+    elif chat_id not in chats:
+        return
+    elif op == 'rename':
+        chats[chat_id]['title'] = event['title']
+    elif op == 'delete':
+        del chats[chat_id]
+    else:
+        # Message events logged by versions that kept messages inline.
+        apply_chat_event(chats[chat_id], event)
+
+def _replay(path, apply, state):
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+    except FileNotFoundError:
+        return state
+    # One read and a bytes split; orjson parses each line faster than a buffered
+    # line iterator can hand it over.
+    for line in data.splitlines():
+        try:
+            event = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # A torn line from an interrupted write. Later appends land after it, so skip
+            # it rather than stop; indexed message events make the skip safe to replay.
+            continue
+        apply(state, event)
+    return state
+
+def _file_version(path):
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    return (file_stat.st_mtime, file_stat.st_size)
+
+def _move_inline_messages():
+    """Move messages that older versions stored in db.json into per-chat files.
+
+    Runs on the writer thread, which owns every log truncation, and re-reads the index
+    there so events appended while it waited end up in the new snapshot.
+    """
+    db = _replay(LOG_FILE, apply_event, _load_snapshot())
+    os.makedirs(CHATS_DIR, exist_ok=True)
+    for chat_id, chat in db['chats'].items():
+        if 'messages' not in chat:
+            continue
+        events = [{'op': 'append_msg', 'msg': msg, 'idx': idx} for idx, msg in enumerate(chat.pop('messages'))]
+        if 'summary' in chat:
+            events.append({'op': 'summarize', 'summary': chat.pop('summary'), 'upto': chat.pop('summary_upto')})
+        # Indexed events replay idempotently, so rerunning an interrupted move is safe.
+        append_durably(chat_file(chat_id), b"".join(orjson.dumps(event, option=orjson.OPT_APPEND_NEWLINE) for event in events))
+    compact_db(db)
+    return db
+
+# Keyed on the file versions so reruns only re-parse after a write. st.cache_resource
+# shares one parsed object per version instead of unpickling a fresh copy on every
+# rerun, so the wrappers below copy just the containers the script mutates.
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _load_db_cached(snapshot_version, log_version):
+    db = _replay(LOG_FILE, apply_event, _load_snapshot())
+    if any('messages' in chat for chat in db['chats'].values()):
+        db = get_writer().submit(_move_inline_messages).result()
+    return db
+
+def load_db():
+    cached = _load_db_cached(_file_version(DB_FILE), _file_version(LOG_FILE))
+    return {**cached, 'chats': {chat_id: dict(chat) for chat_id, chat in cached['chats'].items()}}
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _load_chat_cached(chat_id, chat_version):
+    return _replay(chat_file(chat_id), apply_chat_event, {'messages': []})
+
+def load_chat(chat_id):
+    """Return the cached chat itself; callers that append to it take an editable_chat() first."""
+    return _load_chat_cached(chat_id, _file_version(chat_file(chat_id)))
+
+def editable_chat(chat):
+    # Message dicts are never mutated once stored, so only the list needs copying. This
+    # happens once per sent message rather than on every rerun that just renders the chat.
+    return {**chat, 'messages': list(chat['messages'])}
+
+# Like SQLite's synchronous=NORMAL: fdatasync skips the timestamp-only metadata flush
+# that fsync forces, while still making the data and the file size durable.
+_sync = getattr(os, 'fdatasync', os.fsync)
+
+def _write_durably(file, data):
+    file.write(data)
+    file.flush()
+    _sync(file.fileno())
+
+def append_durably(path, data):
+    """Append `data` to `path` through one unbuffered O_APPEND descriptor and sync it.
+
+    Returns the file's size after the append.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        if size:
+            os.lseek(fd, size - 1, os.SEEK_SET)
+            if os.read(fd, 1) != b"\n":
+                # Terminate a torn line left by an interrupted write, so the new events
+                # start on their own line instead of being glued onto it.
+                data = b"\n" + data
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        _sync(fd)
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+def replace_durably(path, data):
+    """Atomically replace `path` with `data` via a synced sibling temp file and os.replace."""
+    directory = os.path.dirname(os.path.abspath(path))
+    # A unique temp name, so a replace can never write into another one's temp file.
+    # Created with 0o666 rather than mkstemp's 0o600, so a new file gets the umask's
+    # permissions; an existing file keeps its own.
+    tmp_path = os.path.join(directory, f"{os.path.basename(path)}.{secrets.token_hex(8)}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
     try:
-        response = client.chat.completions.create(
-            model="gpt-4.1-nano",
-            messages=[{"role": "user", "content": title_prompt}],
-            max_tokens=15,
-            temperature=0.2,
-        )
-        title = response.choices[0].message.content.strip().replace('"', '')
-        return title if title else DEFAULT_TITLE
+        with open(fd, 'wb') as file:
+            try:
+                os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+            except FileNotFoundError:
+                pass
+            _write_durably(file, data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    if os.name == 'posix':
+        # The rename is only durable once the directory entry is synced as well.
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+def compact_db(db):
+    replace_durably(DB_FILE, orjson.dumps(db))
+    # Every logged event is already in the new snapshot and replays as a no-op,
+    # so crashing before this truncation loses nothing and duplicates nothing.
+    open(LOG_FILE, 'wb').close()
+
+# Writes and fsyncs run on one background thread per process. A single worker keeps
+# every write in submission order; the script only waits for its previous write at
+# the top of the next rerun, before it reads the files back.
+@st.cache_resource
+def get_writer():
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+
+# Event batches from every session wait here until the writer picks them up.
+@st.cache_resource
+def get_write_queue():
+    return queue.SimpleQueue()
+
+def _track_write(future):
+    # Every write of the run is kept, so a failure is reported even when a later write
+    # (such as removing a deleted chat's file) succeeds.
+    st.session_state.setdefault('pending_writes', []).append(future)
+
+def _submit_write(fn, *args):
+    _track_write(get_writer().submit(fn, *args))
+
+def wait_for_pending_write():
+    futures = st.session_state.pop('pending_writes', None)
+    if not futures:
+        return
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            st.toast(f"Could not save chat history: {e}", icon="💾")
+    # No cache clearing: every loader is keyed on (mtime, size), and appends always grow
+    # the file, so the next load after a write already misses the stale entry.
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def delete_chat_file(chat_id):
+    _submit_write(_remove_file, chat_file(chat_id))
+
+# (path, event) pairs queued during this script run; commit_events() writes each
+# file's events as one batch.
+_pending_events = []
+
+def append_event(db, event):
+    """Apply an index event to the in-memory db and queue it for the next commit_events()."""
+    apply_event(db, event)
+    _pending_events.append((LOG_FILE, event))
+
+def append_chat_event(chat_id, chat, event):
+    """Apply a message event to a loaded chat and queue it for the next commit_events()."""
+    if event['op'] == 'append_msg':
+        # Lets replay skip a message that is already in the file.
+        event['idx'] = len(chat['messages'])
+    apply_chat_event(chat, event)
+    _pending_events.append((chat_file(chat_id), event))
+
+def _write_batches(batches):
+    os.makedirs(CHATS_DIR, exist_ok=True)
+    log_size = 0
+    for path, lines in batches.items():
+        size = append_durably(path, b"".join(lines))
+        if path == LOG_FILE:
+            log_size = size
+    if log_size > LOG_COMPACT_BYTES:
+        # Rebuilt from disk: the script's in-memory db keeps changing while this runs.
+        compact_db(_replay(LOG_FILE, apply_event, _load_snapshot()))
+
+def _drain_writes(write_queue):
+    # Everything queued while the previous write was syncing goes out together, with one
+    # sync per file. Later drains find the queue empty and return at once.
+    jobs = []
+    while True:
+        try:
+            jobs.append(write_queue.get_nowait())
+        except queue.Empty:
+            break
+    merged = {}
+    for batches, _ in jobs:
+        for path, lines in batches.items():
+            merged.setdefault(path, []).extend(lines)
+    try:
+        if merged:
+            _write_batches(merged)
     except Exception as e:
-        st.toast(f"Could not generate title: {e}", icon="🤖")
-        return DEFAULT_TITLE
+        for _, future in jobs:
+            future.set_exception(e)
+    else:
+        for _, future in jobs:
+            future.set_result(None)
+
+def commit_events():
+    if not _pending_events:
+        return
+    # Encoded here so the writer thread never touches dicts the script still owns.
+    batches = {}
+    for path, event in _pending_events:
+        batches.setdefault(path, []).append(orjson.dumps(event, option=orjson.OPT_APPEND_NEWLINE))
+    _pending_events.clear()
+    # Each commit gets its own future, so a failed merged write is reported to every
+    # session whose events were in it.
+    future = Future()
+    get_write_queue().put((batches, future))
+    get_writer().submit(_drain_writes, get_write_queue())
+    _track_write(future)
+
+def new_chat_id():
+    # Time-ordered like a UUIDv7 (not in the stdlib before Python 3.14), with a random
+    # suffix so two chats created within the same clock tick cannot collide.
+    return f"{time.time_ns():016x}{secrets.token_hex(4)}"
+
+@functools.lru_cache(maxsize=512)
+def truncate_text(text, max_length=35):
+    return text if len(text) <= max_length else text[:max_length].rstrip() + "..."
+
+def build_chat_index(db):
+    """Return the chat ids, newest first, and their titles as parallel lists."""
+    entries = sorted(
+        ((chat.get('created_at', 0), chat_id, chat.get('title', 'Untitled')) for chat_id, chat in db['chats'].items()),
+        key=itemgetter(0),
+        reverse=True,
+    )
+    return [entry[1] for entry in entries], [entry[2] for entry in entries]
+
+# The sort only reruns when the index files change; the lists are shared, so treat
+# them as read-only.
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _chat_index_cached(snapshot_version, log_version):
+    return build_chat_index(_load_db_cached(snapshot_version, log_version))
+
+def load_chat_index():
+    return _chat_index_cached(_file_version(DB_FILE), _file_version(LOG_FILE))
+
+TITLE_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "chat_title",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"title": {"type": "string"}},
+            "required": ["title"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+def cheap_title(prompt):
+    # Shown in the chat list while the first reply streams; the model's title replaces it
+    # once the turn ends.
+    return ' '.join(prompt.split()[:5])[:60] or DEFAULT_TITLE
+
+def title_excerpt(chat_history):
+    # The opening prompt (and the latest reply, if there is one yet) is all a title needs.
+    first_user = next((msg["content"] for msg in chat_history if msg["role"] == "user"), "")
+    last_assistant = next((msg["content"] for msg in reversed(chat_history) if msg["role"] == "assistant"), "")
+    conversation = f"User: {first_user[:200]}"
+    if last_assistant:
+        conversation += f"\nAssistant: {last_assistant[:200]}"
+    return conversation
+
+async def generate_title(conversation):
+    response = await client.chat.completions.create(
+        model="gpt-4.1-nano",
+        messages=[
+            {"role": "system", "content": "Write a short, concise plain-text title (4-5 words max) for this conversation."},
+            {"role": "user", "content": conversation},
+        ],
+        max_tokens=30,
+        temperature=0.2,
+        response_format=TITLE_RESPONSE_FORMAT,
+    )
+    title = orjson.loads(response.choices[0].message.content)["title"].strip()
+    return title or None
+
+# Memoized on the excerpt, so repeating a conversation start (or re-entering a turn)
+# reuses the in-flight or finished request instead of paying for another round trip.
+@st.cache_resource(show_spinner=False, max_entries=256)
+def request_title(conversation):
+    return run_async(generate_title(conversation))
+
+async def summarize_history(summary, folded):
+    """Return `summary` updated with the `folded` messages."""
+    summary_prompt = f"""
+    Update the summary of a conversation with the new messages below.
+    Keep the facts, names, and decisions needed to continue the conversation. Answer in plain text.
+    ---
+    Current summary: {summary}
+    New messages: {orjson.dumps(folded).decode()}
+    ---
+    Summary:"""
+    response = await client.chat.completions.create(
+        model="gpt-4.1-nano",
+        messages=[{"role": "user", "content": summary_prompt}],
+        temperature=0.2,
+    )
+    return response.choices[0].message.content.strip()
+
+def build_request_messages(chat):
+    # Stored messages are exactly {"role", "content"}, so they are sent as-is. Messages
+    # already folded into the summary are replaced by one system message. If summaries
+    # keep failing, the hard cap still bounds the prompt to the most recent messages.
+    messages = chat['messages']
+    upto = chat.get('summary_upto', 0)
+    start = max(upto, len(messages) - MAX_SENT_MESSAGES)
+    if not upto:
+        return messages[start:] if start else messages
+    return [{"role": "system", "content": "Conversation so far: " + chat['summary']}, *messages[start:]]
+
+def chained_response_id(chat):
+    """Return the stored response that already holds everything before the new prompt.
+
+    The server keeps the whole chain, so it is only reused while the summary has not
+    moved since the chain started and the chain stays under MAX_SENT_MESSAGES;
+    otherwise the next request restarts it from the windowed history.
+    """
+    messages = chat['messages']
+    base = chat.get('summary_upto', 0)
+    if (chat.get('response_id') and chat.get('response_upto') == len(messages) - 1
+            and chat.get('response_base') == base and len(messages) - base <= MAX_SENT_MESSAGES):
+        return chat['response_id']
+    return None
+
+async def open_response_stream(model, previous_id, chat):
+    # The script does not touch `chat` again until this stream is consumed, so the
+    # history is only built here, when it is actually sent.
+    if previous_id:
+        try:
+            return await client.responses.create(model=model, input=chat['messages'][-1:], previous_response_id=previous_id, stream=True)
+        except (openai.NotFoundError, openai.BadRequestError):
+            # Stored responses expire server-side; fall back to sending the history.
+            pass
+    return await client.responses.create(model=model, input=build_request_messages(chat), stream=True)
+
+def cut_off_note(reason):
+    # Only ever rendered; the stored message stays exactly what the model produced.
+    return f"\n\n*[Reply cut off: {reason}]*"
+
+def write_stream(stream):
+    # Deltas are kept as a list and joined on demand, so the reply is only materialised
+    # once per repaint and once more for the log. Repaints are coalesced to one per
+    # STREAM_REPAINT_SECONDS, since each one re-sends and re-parses the whole reply.
+    placeholder = st.empty()
+    parts = []
+    last_repaint = 0.0
+    response_id = None
+    cut_off_reason = None
+    for event in iterate_async(stream):
+        if event.type == "response.output_text.delta":
+            parts.append(event.delta)
+            now = time.monotonic()
+            if now - last_repaint >= STREAM_REPAINT_SECONDS:
+                placeholder.markdown("".join(parts))
+                last_repaint = now
+        elif event.type == "response.completed":
+            # Only a completed response is safe to chain the next turn onto.
+            response_id = event.response.id
+        elif event.type == "response.incomplete":
+            details = event.response.incomplete_details
+            cut_off_reason = details.reason if details else None
+        elif event.type in ("response.failed", "error"):
+            # The SDK hands failures over as stream events instead of raising them.
+            error = event.response.error if event.type == "response.failed" else event
+            raise openai.OpenAIError(f"Response failed: {error.message if error else 'unknown error'}")
+    response = "".join(parts)
+    if response_id is None:
+        # Cut off by a token limit, a content filter or a dropped stream. Keep what
+        # arrived, but flag it, and never store an empty reply.
+        if not response:
+            raise openai.OpenAIError("Response ended without any text")
+        cut_off_reason = cut_off_reason or "stream ended early"
+        placeholder.markdown(response + cut_off_note(cut_off_reason))
+    else:
+        placeholder.markdown(response)
+    return response, response_id, cut_off_reason
+
+def start_turn(chat, needs_title):
+    """Send every request for this turn and return their futures without waiting."""
+    messages = chat['messages']
+    # Continuing a stored response sends only the new prompt instead of the history.
+    previous_id = chained_response_id(chat)
+    turn = {
+        'stream': run_async(open_response_stream(st.session_state["openai_model"], previous_id, chat)),
+        'response_base': chat['response_base'] if previous_id else chat.get('summary_upto', 0),
+        # The title only depends on the opening prompt, so request it alongside the
+        # assistant stream instead of after it.
+        'title': request_title(title_excerpt(messages)) if needs_title else None,
+        'summary': None,
+    }
+    # Once the unsummarized tail outgrows the window, fold its older half into the
+    # summary in the background; the next turn sends the shorter history.
+    summary_upto = chat.get('summary_upto', 0)
+    if len(messages) - summary_upto > HISTORY_WINDOW:
+        turn['summary_upto'] = len(messages) - HISTORY_WINDOW // 2
+        turn['summary'] = run_async(summarize_history(chat.get('summary', '(none)'), messages[summary_upto:turn['summary_upto']]))
+    return turn
+
+def finish_turn(turn):
+    with st.chat_message("assistant"):
+        response, response_id, cut_off_reason = write_stream(turn['stream'].result())
+    new_title = None
+    # The title was requested with the stream, so it is usually ready by now. If not,
+    # the chat keeps its cheap title rather than holding up the end of the turn.
+    if turn['title'] and wait([turn['title']], timeout=TITLE_WAIT_SECONDS).done:
+        new_title = background_result(turn['title'], "Could not generate title")
+        if turn['title'].exception():
+            # Never keep a failed request memoized.
+            request_title.clear()
+    summary = None
+    # A summary that is still running is dropped for this turn; the window is simply
+    # folded again on a later one.
+    if (turn['summary'] and wait([turn['summary']], timeout=SUMMARY_WAIT_SECONDS).done
+            and (summary_text := background_result(turn['summary'], "Could not summarize history"))):
+        summary = (summary_text, turn['summary_upto'])
+    return response, response_id, cut_off_reason, new_title, summary
+
+def render_chat_list(container, chat_ids, chat_titles):
+    # One radio keeps the widget count constant, and only the most recent chats are
+    # sent until the user asks for more, so the payload stays bounded as well. Returns
+    # the selected id and how many chats were listed.
+    active_id = st.session_state.get('active_chat_id')
+    active_index = chat_ids.index(active_id) if active_id in chat_ids else None
+    limit = st.session_state.get('chat_list_limit', RECENT_CHATS)
+    if active_index is not None:
+        limit = max(limit, active_index + 1)
+    selected_id = container.radio(
+        "Previous Chats",
+        chat_ids[:limit],
+        index=active_index,
+        format_func=dict(zip(chat_ids[:limit], map(truncate_text, chat_titles[:limit]))).__getitem__,
+        label_visibility="collapsed",
+    )
+    return selected_id, min(limit, len(chat_ids))
+
+def show_more_chats():
+    st.session_state.chat_list_limit = st.session_state.get('chat_list_limit', RECENT_CHATS) + RECENT_CHATS
+
+# Chats are append-only, so (chat_id, head_len) pins the text; the message list itself
+# is left out of the cache key. Shared across sessions and kept for several chats, so
+# switching back to a chat does not rebuild its history.
+@st.cache_resource(show_spinner=False, max_entries=32)
+def history_head_markdown(chat_id, head_len, _messages, _cut_off):
+    return "\n\n---\n\n".join(
+        f"**{message['role'].capitalize()}:** {message['content']}"
+        + (cut_off_note(_cut_off[idx]) if idx in _cut_off else "")
+        for idx, message in enumerate(_messages[:head_len])
+    )
+
+def render_history(chat_id, chat):
+    # Older messages go out as a single markdown element; only the recent tail gets
+    # per-message chat bubbles.
+    messages = chat['messages']
+    cut_off = chat.get('cut_off', {})
+    head_len = len(messages) - RENDERED_TAIL
+    if head_len > 0:
+        st.markdown(history_head_markdown(chat_id, head_len, messages, cut_off))
+    for idx in range(max(head_len, 0), len(messages)):
+        message = messages[idx]
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"] + (cut_off_note(cut_off[idx]) if idx in cut_off else ""))
 
 # --- Load Database ---
+wait_for_pending_write()
 db = load_db()
 
 # --- Initialize session state for dialog ---
@@ -107,17 +669,18 @@ def edit_chat_dialog(chat_id):
     
     with save_col:
         if st.button("Save title", use_container_width=True):
-            db['chats'][chat_id]['title'] = new_title
-            save_db(db)
+            append_event(db, {'op': 'rename', 'chat_id': chat_id, 'title': new_title})
+            commit_events()
             st.session_state.editing_chat_id = None
             st.rerun()
             
     with delete_col:
         if st.button("Delete chat", type="primary", use_container_width=True):
-            del db['chats'][chat_id]
+            append_event(db, {'op': 'delete', 'chat_id': chat_id})
+            commit_events()
+            delete_chat_file(chat_id)
             if st.session_state.get('active_chat_id') == chat_id:
                 st.session_state.active_chat_id = None
-            save_db(db)
             st.session_state.editing_chat_id = None
             st.rerun()
 
@@ -132,35 +695,33 @@ if st.sidebar.button("➕ New Chat", use_container_width=True):
 
 st.sidebar.subheader("Previous Chats")
 
-sorted_chat_ids = sorted(
-    db.get('chats', {}).keys(),
-    key=lambda cid: db['chats'][cid].get('created_at', 0),
-    reverse=True,
-)
+sorted_chat_ids, chat_titles = load_chat_index()
 
-for chat_id in sorted_chat_ids:
-    chat_info = db['chats'][chat_id]
-    chat_title = chat_info.get('title', 'Untitled')
-    
-    # --- CHANGED: Adjusted column ratio to reshape buttons ---
-    col1, col2 = st.sidebar.columns([0.85, 0.15])
-    
-    with col1:
-        if st.button(
-            chat_title, 
-            key=f"select_{chat_id}", 
-            use_container_width=True,
-            help="Select chat",
-            type="primary" if st.session_state.get('active_chat_id') == chat_id else "secondary"
-        ):
-            st.session_state.active_chat_id = chat_id
-            st.session_state.editing_chat_id = None
-            st.rerun()
+if "active_chat_id" not in st.session_state:
+    st.session_state.active_chat_id = sorted_chat_ids[0] if sorted_chat_ids else None
 
-    with col2:
-        if st.button("⋮", key=f"options_{chat_id}", use_container_width=True, help="Rename chat"):
-            st.session_state.editing_chat_id = chat_id
-            st.rerun()
+# Kept as a slot so a new chat's first turn can redraw the list in place.
+chat_list_slot = st.sidebar.empty()
+
+if sorted_chat_ids:
+    active_id = st.session_state.get('active_chat_id')
+    selected_chat_id, listed_chats = render_chat_list(chat_list_slot, sorted_chat_ids, chat_titles)
+    if selected_chat_id != active_id and selected_chat_id is not None:
+        st.session_state.active_chat_id = selected_chat_id
+        st.session_state.editing_chat_id = None
+
+    hidden_chats = len(sorted_chat_ids) - listed_chats
+    if hidden_chats > 0:
+        # A callback, so the larger limit is already in place when the list renders.
+        st.sidebar.button(f"Show older chats ({hidden_chats})", use_container_width=True, on_click=show_more_chats)
+
+    if st.sidebar.button(
+        "⋮ Manage chat",
+        use_container_width=True,
+        help="Rename or delete the selected chat",
+        disabled=st.session_state.get('active_chat_id') is None,
+    ):
+        st.session_state.editing_chat_id = st.session_state.active_chat_id
 
 # --- Call the dialog function if state is set ---
 if st.session_state.editing_chat_id:
@@ -172,49 +733,91 @@ st.sidebar.header("Configuration")
 models = ["gpt-4.1-nano", "gpt-4o-mini", "gpt-4o", "gpt-4-turbo", "gpt-4", "gpt-3.5-turbo"]
 st.session_state["openai_model"] = st.sidebar.selectbox("Select OpenAI model", models, index=0)
 
-# --- Main Chat Interface (no changes) ---
-if "active_chat_id" not in st.session_state:
-    st.session_state.active_chat_id = sorted_chat_ids[0] if sorted_chat_ids else None
+# --- Main Chat Interface ---
+def render_chat_panel(chat_list_slot=None):
+    """Draw the conversation and run the turn for a submitted prompt.
 
-active_chat_id = st.session_state.active_chat_id
+    An open chat runs as the chat_panel fragment, so sending a message reruns only the
+    conversation. With no chat open there is no history to isolate, so it runs in the
+    full script with the sidebar's chat_list_slot, which a fragment may not write to.
+    """
+    # A fragment rerun skips the top of the script, so catch up on the last write here.
+    wait_for_pending_write()
+    active_chat_id = st.session_state.active_chat_id
 
-if active_chat_id and active_chat_id in db.get('chats', {}):
-    current_chat = db['chats'][active_chat_id]['messages']
-    for message in current_chat:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
-else:
-    st.info('Start a new conversation by typing below or clicking "New Chat".')
+    if active_chat_id in db['chats']:
+        chat = load_chat(active_chat_id)
+        render_history(active_chat_id, chat)
+        intro = None
+    else:
+        intro = st.info('Start a new conversation by typing below or clicking "New Chat".')
+
+    prompt = st.chat_input("What would you like to research?")
+    if not prompt:
+        return
 
-if prompt := st.chat_input("What would you like to research?"):
-    if active_chat_id is None:
-        active_chat_id = str(time.time())
+    chat_list_changed = False
+    if active_chat_id not in db['chats']:
+        active_chat_id = new_chat_id()
         st.session_state.active_chat_id = active_chat_id
-        db['chats'][active_chat_id] = {
-            'title': DEFAULT_TITLE,
-            'messages': [],
-            'created_at': time.time()
-        }
-    
-    db['chats'][active_chat_id]['messages'].append({"role": "user", "content": prompt})
-    
-    with st.chat_message("user"):
-        st.markdown(prompt)
+        append_event(db, {
+            'op': 'new_chat',
+            'chat_id': active_chat_id,
+            'title': cheap_title(prompt),
+            'created_at': time.time(),
+        })
+        chat = {'messages': []}
+        intro.empty()
+        if chat_list_slot is not None:
+            # Listed under its cheap title in this same run, before the request goes out;
+            # the extra option makes it a different radio from the one already drawn.
+            render_chat_list(chat_list_slot, *build_chat_index(db))
+        else:
+            chat_list_changed = True
+    else:
+        chat = editable_chat(chat)
 
-    with st.chat_message("assistant"):
-        stream = client.chat.completions.create(
-            model=st.session_state["openai_model"],
-            messages=[{"role": m["role"], "content": m["content"]} for m in db['chats'][active_chat_id]['messages']],
-            stream=True,
-        )
-        response = st.write_stream(stream)
-    
-    db['chats'][active_chat_id]['messages'].append({"role": "assistant", "content": response})
+    append_chat_event(active_chat_id, chat, {'op': 'append_msg', 'msg': {"role": "user", "content": prompt}})
+    needs_title = len(chat['messages']) == 1
+    # Requests go out first so the user bubble overlaps the time to first token.
+    turn = start_turn(chat, needs_title)
+    try:
+        with st.chat_message("user"):
+            st.markdown(prompt)
 
-    if db['chats'][active_chat_id]['title'] == DEFAULT_TITLE and len(db['chats'][active_chat_id]['messages']) == 2:
-        new_title = generate_title(db['chats'][active_chat_id]['messages'])
-        db['chats'][active_chat_id]['title'] = new_title
-        save_db(db)
-        st.rerun()
-    else:
-        save_db(db)
\ No newline at end of file
+        response, response_id, cut_off_reason, new_title, summary = finish_turn(turn)
+
+        append_chat_event(active_chat_id, chat, {'op': 'append_msg', 'msg': {"role": "assistant", "content": response}})
+        if cut_off_reason:
+            append_chat_event(active_chat_id, chat, {'op': 'cut_off', 'idx': len(chat['messages']) - 1, 'reason': cut_off_reason})
+        if response_id:
+            append_chat_event(active_chat_id, chat, {'op': 'respond', 'id': response_id, 'upto': len(chat['messages']), 'base': turn['response_base']})
+        if summary:
+            summary_text, summary_upto = summary
+            append_chat_event(active_chat_id, chat, {'op': 'summarize', 'summary': summary_text, 'upto': summary_upto})
+
+        old_title = db['chats'][active_chat_id]['title']
+        if new_title and new_title != old_title:
+            append_event(db, {'op': 'rename', 'chat_id': active_chat_id, 'title': new_title})
+            # Only a changed label needs redrawing; an identical radio would also be
+            # registered twice in one run.
+            if truncate_text(new_title) != truncate_text(old_title):
+                chat_list_changed = True
+    finally:
+        # One commit per turn. Running it from `finally` still records the prompt when
+        # the stream fails or Streamlit interrupts the run.
+        commit_events()
+    if chat_list_changed:
+        if chat_list_slot is not None:
+            # Outside the fragment the list is patched in place, with no extra rerun.
+            render_chat_list(chat_list_slot, *build_chat_index(db))
+        else:
+            # A fragment rerun may not touch sidebar widgets, so refresh the whole app.
+            st.rerun()
+
+chat_panel = st.fragment(render_chat_panel)
+
+if st.session_state.active_chat_id in db['chats']:
+    chat_panel()
+else:
+    render_chat_panel(chat_list_slot)